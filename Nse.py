@@ -1,27 +1,164 @@
 from flask import Flask, jsonify, request
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
 import time
 
 app = Flask(__name__)
 
 index_cache = {}
 equity_cache = {}
+CACHE_TTL = 30  # Seconds an entry is served as fresh
+STALE_TTL = 120  # Seconds an entry may be served while it refreshes in the background
+MAX_CACHE_ENTRIES = 512  # Per cache; the oldest entries are evicted first
+MAX_FETCH_LOCKS = 4 * MAX_CACHE_ENTRIES  # Idle locks for uncached URLs are pruned past this
+
+# One lock per upstream URL so only a single thread fetches it at a time.
+fetch_locks = {}
+# Guards index_cache, equity_cache and fetch_locks.
+cache_lock = threading.Lock()
+
+# --- Shared NSE session ---
+# One pooled session so TCP/TLS connections and NSE cookies are reused.
+NSE_HOME = 'https://www.nseindia.com'
+session = requests.Session()
+session.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Encoding': 'gzip, deflate',
+    'Referer': 'https://www.nseindia.com/option-chain'
+})
+session.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
+
+def warm_session():
+    """Visit the NSE homepage so the session holds the cookies the API expects."""
+    session.get(NSE_HOME, timeout=10)
+
+
+def fetch_nse(url):
+    """GET an NSE API url, refreshing the session cookies once if they are rejected."""
+    if not session.cookies:
+        warm_session()
+    resp = session.get(url, timeout=10)
+    if resp.status_code in (401, 403):
+        warm_session()
+        resp = session.get(url, timeout=10)
+    resp.raise_for_status()
+    return resp
+
+
+# --- Cache helpers ---
+def fetch_lock(url):
+    """Return the lock that serializes fetches of url."""
+    with cache_lock:
+        lock = fetch_locks.get(url)
+        if lock is None:
+            if len(fetch_locks) >= MAX_FETCH_LOCKS:
+                prune_fetch_locks()
+            lock = fetch_locks[url] = threading.Lock()
+        return lock
+
+
+def prune_fetch_locks():
+    """Drop idle locks for URLs that are not cached. Caller holds cache_lock."""
+    cached_urls = {entry['url'] for cache in (index_cache, equity_cache) for entry in cache.values()}
+    for url, lock in list(fetch_locks.items()):
+        if url not in cached_urls and not lock.locked():
+            del fetch_locks[url]
+
+
+def refresh_cache(cache, key, url):
+    """
+    Fetch url into cache[key], evicting the oldest entries past
+    MAX_CACHE_ENTRIES together with their idle fetch locks.
+    """
+    resp = fetch_nse(url)
+    resp.json()  # Only cache bodies that parse as JSON.
+    entry = {
+        # Served verbatim, so cache hits never re-encode the payload.
+        'body': resp.content,
+        # blake2b is only used as a cheap change detector for ETags.
+        'etag': hashlib.blake2b(resp.content, digest_size=8).hexdigest(),
+        'timestamp': time.time(),
+        'url': url
+    }
+    with cache_lock:
+        cache.pop(key, None)  # Re-insert so dict order tracks entry age.
+        cache[key] = entry
+        while len(cache) > MAX_CACHE_ENTRIES:
+            evicted = cache.pop(next(iter(cache)))
+            lock = fetch_locks.get(evicted['url'])
+            if lock is not None and not lock.locked():
+                del fetch_locks[evicted['url']]
+    return entry
+
+
+def refresh_in_background(cache, key, url):
+    """Refresh cache[key] on a daemon thread unless a fetch is already running."""
+    lock = fetch_lock(url)
+    if not lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            refresh_cache(cache, key, url)
+        except Exception as e:
+            print(f"Background refresh of {url} failed: {e}")
+        finally:
+            lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_cached(cache, key, url):
+    """
+    Return the cache entry for key, fetching url when it is missing or too old.
+    Entries younger than STALE_TTL are returned at once and refreshed in the
+    background; concurrent misses wait for a single upstream fetch.
+    """
+    entry = cache.get(key)
+    if entry:
+        age = time.time() - entry['timestamp']
+        if age < CACHE_TTL:
+            return entry
+        if age < STALE_TTL:
+            refresh_in_background(cache, key, url)
+            return entry
+
+    with fetch_lock(url):
+        # Another thread may have filled the entry while we waited.
+        entry = cache.get(key)
+        if entry and time.time() - entry['timestamp'] < CACHE_TTL:
+            return entry
+        return refresh_cache(cache, key, url)
+
+
+def cached_response(entry):
+    """Serve a cache entry, answering 304 when the client already holds its ETag."""
+    if request.if_none_match.contains(entry['etag']):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_TTL
+    return response
+
 
 # --- NSE Index Option Chain ---
 @app.route('/nse-index', methods=['GET'])
 def nse_index():
     symbol = request.args.get('symbol', 'NIFTY').upper()
-    now = time.time()
-
-    # 30 sec cache
-    if symbol in index_cache and now - index_cache[symbol]['timestamp'] < 30:
-        return jsonify(index_cache[symbol]['data'])
-
     url = f'https://www.nseindia.com/api/option-chain-indices?symbol={symbol}'
     try:
-        data = requests.get(url, timeout=10).json()
-        index_cache[symbol] = {'data': data, 'timestamp': now}
-        return jsonify(data)
+        return cached_response(get_cached(index_cache, symbol, url))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -33,19 +170,14 @@ def nse_equity():
     if not symbol:
         return jsonify({'error': 'Symbol is required'}), 400
 
-    now = time.time()
-    if symbol in equity_cache and now - equity_cache[symbol]['timestamp'] < 30:
-        return jsonify(equity_cache[symbol]['data'])
-
     url = f'https://www.nseindia.com/api/option-chain-equities?symbol={symbol}'
     try:
-        data = requests.get(url, timeout=10).json()
-        equity_cache[symbol] = {'data': data, 'timestamp': now}
-        return jsonify(data)
+        return cached_response(get_cached(equity_cache, symbol, url))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server only; run under gunicorn (see gunicorn.conf.py) in production.
+    app.run()
           
@@ -1,26 +1,88 @@
+import asyncio
 import os
 import uuid
+import functools
 import hashlib
+import json
+import mimetypes
+import mmap
 import threading
 import time
 import subprocess
 from datetime import datetime
-from flask import Flask, request, jsonify
+from urllib.parse import quote
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 app = Flask(__name__)
 CORS(app)
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # 2GB limit
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
+FFMPEG_PATH = "/usr/local/bin/ffmpeg"
+FFPROBE_PATH = "/usr/local/bin/ffprobe"
 ALLOWED_EXTENSIONS = {'mp4', 'mov', 'avi', 'mkv', 'webm'}
+SUPPORTED_PLATFORMS = {'youtube', 'facebook', 'instagram', 'twitter'}
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB reads when hashlib.file_digest is unavailable
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB writes, hashed as they stream in
+LOG_CHUNK_SIZE = 64 * 1024  # ffmpeg output is written to its log in batches of this size
+MMAP_HASH_THRESHOLD = 100 * 1024 * 1024  # Files above this are hashed through mmap
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Set when nginx fronts the app and serves uploads from an internal /protected/ location.
+app.config['USE_X_ACCEL_REDIRECT'] = os.environ.get('USE_X_ACCEL_REDIRECT') == '1'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # In-memory storage for active streams and file hashes.
 active_streams = {}
+streams_lock = threading.Lock()  # Guards active_streams.
 video_hashes = {}
+video_paths = {}  # video_id -> saved upload path
+# video_id -> codecs, bitrate and container from ffprobe, used to skip re-encoding.
+video_meta = {}
+video_sha256 = {}  # video_id -> SHA-256, computed the first time a fast-hash hit needs it
+hashes_lock = threading.Lock()  # Guards video_hashes, video_paths, video_meta and video_sha256.
+
+# One event loop thread owns every delayed cleanup instead of a Timer thread each.
+timer_loop = asyncio.new_event_loop()
+threading.Thread(target=timer_loop.run_forever, name='timers', daemon=True).start()
+timer_handles = {}  # Keyed callbacks (delete_if_not_streamed by video_id)
+
+def schedule(delay, callback, *args, key=None):
+    """
+    Run callback(*args) on the timer loop after delay seconds. Keyed
+    callbacks can be cancelled with cancel_scheduled(key).
+    """
+    def fire():
+        if key is not None:
+            timer_handles.pop(key, None)
+        callback(*args)
+
+    def arm():
+        handle = timer_loop.call_later(delay, fire)
+        if key is not None:
+            timer_handles[key] = handle
+
+    timer_loop.call_soon_threadsafe(arm)
+
+def cancel_scheduled(key):
+    """Cancel the pending callback registered under key, if any."""
+    def cancel():
+        handle = timer_handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+    timer_loop.call_soon_threadsafe(cancel)
 
 def allowed_file(filename):
     """Check whether the filename has an allowed extension."""
@@ -28,28 +90,169 @@ def allowed_file(filename):
 
 def compute_file_hash(file_path):
     """Compute the SHA-256 hash of the file."""
-    sha256 = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with open(file_path, 'rb', buffering=0) as f:
+        if os.fstat(f.fileno()).st_size > MMAP_HASH_THRESHOLD:
+            # Hash straight from the page cache in a single C call.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return hashlib.sha256(mm).hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: the read/update loop runs entirely in C.
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
             sha256.update(chunk)
-    return sha256.hexdigest()
+        return sha256.hexdigest()
+
+def new_upload_hasher():
+    """
+    Return the hasher used for video_hashes keys: XXH3-128 when xxhash is
+    installed, otherwise a 128-bit BLAKE2b. SHA-256 is kept for confirming hits.
+    """
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def forget_video(video_id):
+    """Drop a deleted video from the path, hash and metadata indexes."""
+    with hashes_lock:
+        video_paths.pop(video_id, None)
+        video_meta.pop(video_id, None)
+        video_sha256.pop(video_id, None)
+        for file_hash, vid in list(video_hashes.items()):
+            if vid == video_id:
+                del video_hashes[file_hash]
+
+def claim_video_hash(file_hash, video_id):
+    """
+    Record file_hash for video_id unless an upload that is still on disk
+    already owns it, and return the owning video id. An entry left behind by
+    a deleted upload is taken over, so it cannot switch dedup off for good.
+    """
+    with hashes_lock:
+        owner = video_hashes.get(file_hash)
+        owner_path = video_paths.get(owner)
+        if owner_path is None or not os.path.exists(owner_path):
+            video_hashes[file_hash] = owner = video_id
+        return owner
+
+def confirm_duplicate(existing_video_id, file_path):
+    """
+    Confirm a fast-hash hit: sizes must match, then SHA-256. The existing
+    upload's SHA-256 is computed once and kept, and the new file was just
+    written, so its hash is read back from the page cache.
+    """
+    existing_path = video_paths.get(existing_video_id)
+    try:
+        if not existing_path or os.path.getsize(existing_path) != os.path.getsize(file_path):
+            return False
+        existing_sha256 = video_sha256.get(existing_video_id)
+        if existing_sha256 is None:
+            existing_sha256 = compute_file_hash(existing_path)
+            with hashes_lock:
+                if existing_video_id in video_paths:
+                    video_sha256[existing_video_id] = existing_sha256
+    except OSError:
+        return False  # The existing upload was deleted meanwhile.
+    return compute_file_hash(file_path) == existing_sha256
+
+def probe_video(video_id, file_path):
+    """Record the upload's codecs, bitrates, audio format and container in video_meta."""
+    try:
+        result = subprocess.run(
+            [FFPROBE_PATH, '-v', 'error', '-of', 'json',
+             '-show_entries', 'stream=codec_type,codec_name,bit_rate,sample_rate,channels:format=bit_rate', file_path],
+            capture_output=True,
+            text=True,
+            timeout=30,
+            check=True
+        )
+        info = json.loads(result.stdout)
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        print(f"[{datetime.now()}] ffprobe failed for '{file_path}': {e}")
+        return
+
+    meta = {
+        'container': file_path.rsplit('.', 1)[1].lower(),
+        'video_codec': None,
+        'audio_codec': None,
+        'audio_sample_rate': None,
+        'audio_channels': None,
+        'audio_bitrate': None,
+        'bitrate': None
+    }
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == 'video' and meta['video_codec'] is None:
+            meta['video_codec'] = stream.get('codec_name')
+            if stream.get('bit_rate'):
+                meta['bitrate'] = int(stream['bit_rate'])
+        elif stream.get('codec_type') == 'audio' and meta['audio_codec'] is None:
+            meta['audio_codec'] = stream.get('codec_name')
+            meta['audio_sample_rate'] = int(stream['sample_rate']) if stream.get('sample_rate') else None
+            meta['audio_channels'] = stream.get('channels')
+            meta['audio_bitrate'] = int(stream['bit_rate']) if stream.get('bit_rate') else None
+    # Some containers only report the overall rate, which is an upper bound.
+    if meta['bitrate'] is None and info.get('format', {}).get('bit_rate'):
+        meta['bitrate'] = int(info['format']['bit_rate'])
+    with hashes_lock:
+        if video_id in video_paths:
+            video_meta[video_id] = meta
 
 def delete_if_not_streamed(video_id, file_path):
     """
     After a delay, if the video hasn't been started for streaming,
     delete the file and remove its hash from video_hashes.
     """
-    if video_id not in active_streams:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"[{datetime.now()}] File '{file_path}' deleted due to inactivity.")
-                # Remove the hash corresponding to video_id.
-                for file_hash, vid in list(video_hashes.items()):
-                    if vid == video_id:
-                        del video_hashes[file_hash]
-        except Exception as e:
-            print(f"Error deleting file: {e}")
+    with streams_lock:
+        if video_id in active_streams:
+            return
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            print(f"[{datetime.now()}] File '{file_path}' deleted due to inactivity.")
+            forget_video(video_id)
+    except Exception as e:
+        print(f"Error deleting file: {e}")
+
+def video_id_from_filename(name):
+    """Return the video_id of an upload named {email}_{video_id}.{ext}, or None."""
+    if not allowed_file(name):
+        return None
+    stem = name.rsplit('.', 1)[0]
+    return stem.rsplit('_', 1)[1] if '_' in stem else None
+
+def load_video_paths():
+    """Rebuild video_paths from the uploads already on disk."""
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            video_id = video_id_from_filename(entry.name)
+            if video_id and entry.is_file():
+                video_paths[video_id] = entry.path
+
+def watch_upload_folder():
+    """Keep video_paths in sync with files added or removed by other processes."""
+    inotify = INotify()
+    # Uploads are written to a .part file and renamed into place when
+    # complete, so only a rename marks a finished upload.
+    added = inotify_flags.MOVED_TO
+    inotify.add_watch(UPLOAD_FOLDER, added | inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+    while True:
+        for event in inotify.read():
+            video_id = video_id_from_filename(event.name)
+            if video_id is None:
+                continue
+            path = os.path.join(UPLOAD_FOLDER, event.name)
+            if event.mask & added:
+                with hashes_lock:
+                    video_paths[video_id] = path
+            elif video_paths.get(video_id) == path:
+                # Drop its hashes too, or they would shadow a re-upload.
+                forget_video(video_id)
+
+load_video_paths()
+if INotify is not None:
+    threading.Thread(target=watch_upload_folder, name='uploads-watch', daemon=True).start()
 
 @app.route('/upload/<email>', methods=['POST'])
 def upload_video(email):
@@ -65,49 +268,115 @@ def upload_video(email):
         ext = file.filename.rsplit('.', 1)[1].lower()
         filename = f"{email}_{video_id}.{ext}"
         save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        # Write under a temporary name and move it into place once accepted,
+        # so the folder watcher never sees partial or duplicate uploads.
+        part_path = save_path + '.part'
 
         try:
             print(f"[{datetime.now()}] Saving file to {save_path}")
-            with open(save_path, 'wb') as f:
+            hasher = new_upload_hasher()
+            with open(part_path, 'wb') as f:
+                # Reserve the space up front to avoid fragmenting the file as it
+                # grows; the request body is an upper bound, trimmed below.
+                if request.content_length and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, request.content_length)
+                    except OSError:
+                        pass
                 while True:
-                    chunk = file.stream.read(4096)
+                    chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
                     if not chunk:
                         break
+                    # Hash while writing so the file never has to be read back.
+                    hasher.update(chunk)
                     f.write(chunk)
+                f.truncate()
 
             print(f"[{datetime.now()}] File saved successfully")
 
-            # Respond early before expensive processing
-            response = jsonify({
+            file_hash = hasher.hexdigest()
+            existing_video_id = claim_video_hash(file_hash, video_id)
+            if existing_video_id != video_id:
+                # Confirm the fast-hash hit before discarding anything.
+                if confirm_duplicate(existing_video_id, part_path):
+                    # Duplicate found: remove new file and return existing video id.
+                    print(f"[{datetime.now()}] Duplicate detected. Removing file.")
+                    os.remove(part_path)
+                    return jsonify({
+                        'message': 'Duplicate video',
+                        'videoId': existing_video_id
+                    }), 200
+
+            os.replace(part_path, save_path)
+            with hashes_lock:
+                video_paths[video_id] = save_path
+
+            # Schedule deletion in 15 minutes if stream not started.
+            schedule(15 * 60, delete_if_not_streamed, video_id, save_path, key=video_id)
+
+            # Probe codecs now so /start can decide whether re-encoding is needed.
+            threading.Thread(target=probe_video, args=(video_id, save_path), daemon=True).start()
+
+            return jsonify({
                 'message': 'File uploaded successfully',
                 'videoId': video_id,
                 'filename': filename,
                 'duration': 120  # dummy or replace with actual later
-            })
-            response.status_code = 200
-
-            # Background task: hashing and duplicate check
-            def post_process():
-                try:
-                    file_hash = compute_file_hash(save_path)
-                    if file_hash in video_hashes:
-                        print(f"[{datetime.now()}] Duplicate detected. Removing file.")
-                        os.remove(save_path)
-                    else:
-                        video_hashes[file_hash] = video_id
-                        threading.Timer(15 * 60, lambda: delete_if_not_streamed(video_id, save_path)).start()
-                except Exception as e:
-                    print(f"[{datetime.now()}] Post-process error: {e}")
-
-            threading.Thread(target=post_process).start()
-
-            return response
+            }), 200
 
         except Exception as e:
+            # Undo the failed upload: a half-written (possibly preallocated,
+            # full-size) file must not be left behind, nor the hash it claimed.
+            for path in (part_path, save_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            forget_video(video_id)
             return jsonify({'error': str(e)}), 500
 
     return jsonify({'error': 'Invalid file type'}), 400
 
+@app.route('/video/<video_id>', methods=['GET'])
+def serve_video(video_id):
+    """
+    Serve an uploaded video for playback. Behind nginx the bytes are handed
+    off with X-Accel-Redirect so they go out via sendfile() without passing
+    through Python:
+
+        location /protected/ {
+            internal;
+            alias /path/to/uploads/;
+            sendfile on;
+            tcp_nopush on;
+            aio threads;
+        }
+    """
+    video_path = video_paths.get(video_id)
+    if not video_path or not os.path.exists(video_path):
+        return jsonify({'error': 'Video file not found'}), 404
+
+    mimetype = mimetypes.guess_type(video_path)[0] or 'application/octet-stream'
+    if not app.config['USE_X_ACCEL_REDIRECT']:
+        return send_file(video_path, mimetype=mimetype, conditional=True)
+
+    response = app.response_class(mimetype=mimetype)
+    response.headers['X-Accel-Redirect'] = f"/protected/{quote(os.path.basename(video_path))}"
+    return response
+
+def update_stream(video_id, **fields):
+    """Update a stream record in active_streams, if it is still there."""
+    with streams_lock:
+        record = active_streams.get(video_id)
+        if record is not None:
+            record.update(fields)
+
+def forget_stream(video_id):
+    """Remove a finished stream's record from active_streams."""
+    # A /start after a failed launch may have replaced the record meanwhile.
+    with streams_lock:
+        record = active_streams.get(video_id)
+        if record is not None and record['status'] not in ('starting', 'live'):
+            del active_streams[video_id]
+
 def cleanup_process(process):
     """Terminate and kill a process if still running."""
     try:
@@ -119,15 +388,136 @@ def cleanup_process(process):
     except Exception as e:
         print(f"Error cleaning up process: {e}")
 
+# Hardware H.264 encoders in order of preference:
+# name -> (flags before the input, flags replacing -preset/-x264-params).
+HW_ENCODERS = {
+    'h264_nvenc': ([], ['-preset', 'p4', '-rc', 'cbr']),
+    'h264_qsv': ([], ['-preset', 'veryfast']),
+    'h264_vaapi': (['-vaapi_device', '/dev/dri/renderD128'], ['-vf', 'format=nv12,hwupload', '-rc_mode', 'CBR']),
+}
+
+@functools.lru_cache(maxsize=None)
+def detect_hw_encoder():
+    """
+    Return the first hardware encoder that can actually encode a test frame
+    on this host, or None to stay on libx264. Probed once and cached.
+    """
+    for encoder, (input_flags, encoder_opts) in HW_ENCODERS.items():
+        try:
+            result = subprocess.run(
+                [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', *input_flags,
+                 '-f', 'lavfi', '-i', 'nullsrc=s=256x256:d=1', '-frames:v', '1',
+                 '-c:v', encoder, *encoder_opts, '-f', 'null', '-'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=15
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        if result.returncode == 0:
+            print(f"[{datetime.now()}] Using hardware encoder {encoder}")
+            return encoder
+    return None
+
+def encoder_flags(common_flags):
+    """
+    Split a platform's flag string into (input_flags, codec_flags), swapping
+    libx264 and its x264-only options for the detected hardware encoder.
+    """
+    tokens = common_flags.split()
+    encoder = detect_hw_encoder()
+    if encoder is None:
+        return [], tokens
+    input_flags, encoder_opts = HW_ENCODERS[encoder]
+    codec_flags = []
+    it = iter(tokens)
+    for token in it:
+        if token in ('-preset', '-x264-params'):
+            next(it, None)
+            continue
+        codec_flags.append(encoder if token == 'libx264' else token)
+    return input_flags, codec_flags + encoder_opts
+
+def can_stream_copy(meta, common_flags):
+    """
+    Return True when the upload can be sent as-is: H.264 (with AAC or no
+    audio) in an FLV-compatible container, no faster than the platform's
+    video bitrate, with audio matching the platform's -ar/-ac/-b:a settings.
+    Platforms that demand strict CBR are always re-encoded. Only mp4/mov/flv
+    inputs qualify, since those are the ones ffmpeg's default input probe
+    reliably reads the codec parameters of.
+    """
+    if not meta or meta['video_codec'] != 'h264' or meta['audio_codec'] not in (None, 'aac'):
+        return False
+    if meta['container'] not in ('mp4', 'mov', 'flv') or meta['bitrate'] is None:
+        return False
+    tokens = common_flags.split()
+    if 'nal-hrd=cbr:force-cfr=1' in tokens or '-b:v' not in tokens:
+        return False
+    if meta['audio_codec'] is not None:
+        if '-ar' in tokens and meta['audio_sample_rate'] != int(tokens[tokens.index('-ar') + 1]):
+            return False
+        if '-ac' in tokens and meta['audio_channels'] != int(tokens[tokens.index('-ac') + 1]):
+            return False
+        if '-b:a' in tokens:
+            audio_target = int(tokens[tokens.index('-b:a') + 1].rstrip('k')) * 1000
+            if meta['audio_bitrate'] is None or meta['audio_bitrate'] > audio_target:
+                return False
+    target = tokens[tokens.index('-b:v') + 1]
+    return meta['bitrate'] <= int(target.rstrip('k')) * 1000
+
+# Probe in the background so the first stream doesn't wait for it.
+threading.Thread(target=detect_hw_encoder, daemon=True).start()
+
+def pump_log(pipe, log_file):
+    """
+    Copy ffmpeg's diagnostic output to its log file. Reads take whatever is
+    available and writes go through a LOG_CHUNK_SIZE buffer, so chatty
+    encoder output turns into a few large writes and never backs up the pipe.
+    """
+    with pipe, open(log_file, 'wb', buffering=LOG_CHUNK_SIZE) as log:
+        while True:
+            chunk = pipe.read1(LOG_CHUNK_SIZE)
+            if not chunk:
+                break
+            log.write(chunk)
+
+def watch_ffmpeg_progress(pipe, video_id):
+    """
+    Read ffmpeg's -progress output and keep the stream record current:
+    'live' once frames are being published, and the latest progress
+    metrics in between. The final status is left to run_ffmpeg_stream,
+    which knows the exit code.
+    """
+    progress = {}
+    with pipe:
+        for line in pipe:
+            key, sep, value = line.decode(errors='replace').strip().partition('=')
+            if not sep:
+                continue
+            progress[key] = value
+            if key == 'frame':
+                # Frames are only reported once the output is open and
+                # accepting data, so the stream is live from here on.
+                with streams_lock:
+                    record = active_streams.get(video_id)
+                    if record is not None and record['status'] == 'starting':
+                        record['status'] = 'live'
+            elif key == 'progress':
+                # One progress block is complete; publish a snapshot of it.
+                update_stream(video_id, progress={k: progress.get(k) for k in ('frame', 'fps', 'bitrate', 'out_time', 'speed')})
+
 def run_ffmpeg_stream(video_path, stream_key, loops, video_id, task_id, platform):
+    process = None
     try:
         print(f"[{datetime.now()}] Starting FFmpeg stream for '{video_path}'")
+        # The upload is being streamed, so it must not expire.
+        cancel_scheduled(video_id)
         # Determine output URL: if stream_key starts with 'rtmp://', use it as is.
         os.makedirs("logs", exist_ok=True)
         log_file = f"logs/{video_id}.log"
         # Construct the base FFmpeg command.
-        ffmpeg_path = "/usr/local/bin/ffmpeg"
-        ffmpeg_input = f'-re -stream_loop {loops} -i "{video_path}"'
+        ffmpeg_input = ['-re', '-stream_loop', str(loops), '-i', video_path]
 
         if platform == 'youtube':
             output_url = f'rtmp://a.rtmp.youtube.com/live2/{stream_key}'        
@@ -165,82 +555,98 @@ def run_ffmpeg_stream(video_path, stream_key, loops, video_id, task_id, platform
         else:
             return f"Unsupported platform: {platform}"
 
-        base_cmd = f'{ffmpeg_path} {ffmpeg_input} {common_flags} {format_flags} "{output_url}"'
-
+        # Pass argv directly: no shell hop, and nothing in stream_key or video_path is interpreted.
+        if can_stream_copy(video_meta.get(video_id), common_flags):
+            # The source already fits the platform, so skip the encoder entirely.
+            hw_flags, codec_flags = [], ['-c', 'copy']
+        else:
+            hw_flags, codec_flags = encoder_flags(common_flags)
+        # Machine-readable progress goes to stdout; diagnostics go to the log.
+        argv = [FFMPEG_PATH, '-progress', 'pipe:1', '-nostats', *hw_flags, *ffmpeg_input,
+                *codec_flags, *format_flags.split(), output_url]
+
+        # Register the record before launching so launch errors are reported too.
+        with streams_lock:
+            active_streams[video_id] = {
+                'process': None,
+                'status': 'starting',
+                'task_id': task_id,
+                'start_time': datetime.now().isoformat()
+            }
 
         # Run FFmpeg and log output
-        with open(log_file, 'w') as log:
-            process = subprocess.Popen(
-                base_cmd,
-                shell=True,
-                stdout=log,
-                stderr=subprocess.STDOUT,
-                executable='/bin/bash'  # Ensure Bash is used
-            )
-        
-        # Save process info in active_streams.
-        active_streams[video_id] = {
-            'process': process,
-            'status': 'starting',
-            'task_id': task_id,
-            'start_time': datetime.now().isoformat()
-        }
-        
-        # Optionally, wait a few seconds to let the process initialize.
-        time.sleep(5)
-        active_streams[video_id]['status'] = 'live'
+        process = subprocess.Popen(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=1024 * 1024,
+            close_fds=True
+        )
+        log_writer = threading.Thread(target=pump_log, args=(process.stderr, log_file), daemon=True)
+        log_writer.start()
+        update_stream(video_id, process=process)
+
+        # The progress watcher flips the status to 'live' on the first frame,
+        # so a slow or failing RTMP(S) handshake is never reported as live.
+        watcher = threading.Thread(target=watch_ffmpeg_progress, args=(process.stdout, video_id), daemon=True)
+        watcher.start()
 
-        # Here, since FFmpeg is running in a separate terminal, monitoring its output is limited.
         # We'll simply wait for the process to complete.
         process.wait()
-        active_streams[video_id]['status'] = 'completed'
+        log_writer.join()
+        watcher.join()
+        if process.returncode == 0:
+            update_stream(video_id, status='completed')
+        else:
+            update_stream(video_id, status='error', error=f"ffmpeg exited with code {process.returncode}")
     except Exception as e:
-        active_streams[video_id]['status'] = 'error'
-        active_streams[video_id]['error'] = str(e)
+        update_stream(video_id, status='error', error=str(e))
         print(f"Error in run_ffmpeg_stream: {e}")
     finally:
         cleanup_process(process)
-        # Wait a bit to give the OS time to release the file.
-        time.sleep(2)
-        # Remove the video file after the stream has ended using a retry loop.
-        attempts = 0
-        max_attempts = 5
-        while attempts < max_attempts:
-            try:
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                    print(f"[{datetime.now()}] File '{video_path}' removed after livestream ended.")
-                    # Remove the hash corresponding to video_id.
-                    for file_hash, vid in list(video_hashes.items()):
-                        if vid == video_id:
-                            del video_hashes[file_hash]
-                break  # Exit loop if deletion is successful.
-            except Exception as e:
-                print(f"Error during post-stream cleanup (attempt {attempts+1}): {e}")
-                attempts += 1
-                time.sleep(2)
+        if process is None:
+            # FFmpeg never started: keep the upload for another /start and
+            # let it expire as if it had never been streamed.
+            schedule(15 * 60, delete_if_not_streamed, video_id, video_path, key=video_id)
+        else:
+            # Wait a bit to give the OS time to release the file.
+            time.sleep(2)
+            # Remove the video file after the stream has ended using a retry loop.
+            attempts = 0
+            max_attempts = 5
+            while attempts < max_attempts:
+                try:
+                    if os.path.exists(video_path):
+                        os.remove(video_path)
+                        print(f"[{datetime.now()}] File '{video_path}' removed after livestream ended.")
+                        forget_video(video_id)
+                    break  # Exit loop if deletion is successful.
+                except Exception as e:
+                    print(f"Error during post-stream cleanup (attempt {attempts+1}): {e}")
+                    attempts += 1
+                    time.sleep(2)
         # Optionally, remove the stream record after a delay.
-        threading.Timer(300, lambda: active_streams.pop(video_id, None)).start()
+        schedule(300, forget_stream, video_id)
 
 @app.route('/start/<video_id>', methods=['POST'])
 def start_stream(video_id):
     """
     Start streaming endpoint:
       - Expects JSON with keys: streamKey, loops, taskId.
-      - Finds the video file containing the video_id.
+      - Looks up the uploaded file for video_id.
       - Starts the streaming (in a background thread) using run_ffmpeg_stream.
     """
     data = request.get_json()
     required_fields = ['streamKey', 'loops', 'taskId', 'platform']
     if not all(field in data for field in required_fields):
         return jsonify({'error': 'Missing required fields'}), 400
+    if data['platform'] not in SUPPORTED_PLATFORMS:
+        return jsonify({'error': f"Unsupported platform: {data['platform']}"}), 400
 
-    # Find the video file (assumes filename contains the video_id).
-    video_files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if video_id in f]
-    if not video_files:
+    video_path = video_paths.get(video_id)
+    if not video_path or not os.path.exists(video_path):
         return jsonify({'error': 'Video file not found'}), 404
 
-    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_files[0])
     # Start the FFmpeg streaming in a background thread.
     thread = threading.Thread(
         target=run_ffmpeg_stream,
@@ -0,0 +1,24 @@
+# Production server settings for the Flask apps in this repo, e.g.
+#   gunicorn -c gunicorn.conf.py main:app
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#   WEB_CONCURRENCY=$(nproc) gunicorn -c gunicorn.conf.py Nse:app
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# The video apps keep active streams and upload hashes in process memory, so
+# they must run a single worker; Nse.py only caches and can run one per core.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Keep the worker heartbeat file off disk.
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Recycling a worker drops its in-memory state, so only enable this for Nse.py.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# Uploads of up to 2 GB must not be cut off by the worker timeout.
+timeout = 0
+limit_request_line = 0
@@ -1,26 +1,42 @@
 import os
 import uuid
 import hashlib
+import sched
 import threading
 import time
 import subprocess
-import platform
+from collections import OrderedDict
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
+try:
+    from blake3 import blake3  # Optional: faster dedup hashing.
+except ImportError:
+    blake3 = None
+
 app = Flask(__name__)
 CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'mp4', 'mov', 'avi', 'mkv', 'webm'}
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB reads when hashlib.file_digest is unavailable
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB reads from the upload stream
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# In-memory storage for active streams and file hashes.
-active_streams = {}
-video_hashes = {}
+# In-memory storage for active streams and file hashes. Both are kept in
+# least-recently-used order and capped so they cannot grow without bound.
+MAX_STREAM_RECORDS = 1024
+MAX_VIDEO_HASHES = 10_000
+active_streams = OrderedDict()
+streams_lock = threading.Lock()  # Guards active_streams.
+video_hashes = OrderedDict()
+id_to_hash = {}  # Reverse index of video_hashes: video_id -> file hash.
+hashes_lock = threading.Lock()  # Guards video_hashes and id_to_hash.
+video_paths = {}  # video_id -> path of its uploaded file.
+pending_deletions = {}  # video_id -> scheduled delete_if_not_streamed event.
 
 def allowed_file(filename):
     """Check whether the filename has an allowed extension."""
@@ -28,28 +44,160 @@ def allowed_file(filename):
 
 def compute_file_hash(file_path):
     """Compute the SHA-256 hash of the file."""
-    sha256 = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with open(file_path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            # Hint the kernel that the whole file is read front to back.
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: the read/update loop runs entirely in C.
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
             sha256.update(chunk)
-    return sha256.hexdigest()
+        return sha256.hexdigest()
+
+def new_content_hasher():
+    """Return a fresh hasher for streamed uploads: blake3 if installed, else SHA-256."""
+    return blake3() if blake3 is not None else hashlib.sha256()
+
+def content_key(hasher):
+    """Format a finished hasher as a video_hashes key prefixed with its algorithm."""
+    prefix = 'b3' if blake3 is not None else 'sha256'
+    return f"{prefix}:{hasher.hexdigest()}"
+
+def save_upload(stream, save_path):
+    """
+    Copy an upload stream to save_path and return the content key of the
+    bytes written, so the file never has to be read back just to hash it.
+
+    Data is written to a '.part' file that is renamed into place once
+    complete, so a partial upload is never visible.
+    """
+    part_path = save_path + '.part'
+    hasher = new_content_hasher()
+    try:
+        with open(part_path, 'wb') as f:
+            if hasattr(stream, 'readinto'):
+                # Reuse one buffer instead of allocating a new bytes object per block.
+                buf = bytearray(UPLOAD_CHUNK_SIZE)
+                view = memoryview(buf)
+                while True:
+                    n = stream.readinto(buf)
+                    if not n:
+                        break
+                    f.write(view[:n])
+                    hasher.update(view[:n])
+            else:
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    hasher.update(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+            if hasattr(os, 'posix_fadvise'):
+                # Nothing here re-reads the upload soon; free its page cache.
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        os.replace(part_path, save_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return content_key(hasher)
+
+def remember_video_hash(file_hash, video_id):
+    """
+    Record file_hash for video_id unless it is already known.
+    Returns the video id that already owns the hash, or None.
+    """
+    with hashes_lock:
+        existing_video_id = video_hashes.get(file_hash)
+        if existing_video_id is not None:
+            video_hashes.move_to_end(file_hash)
+            return existing_video_id
+        video_hashes[file_hash] = video_id
+        id_to_hash[video_id] = file_hash
+        while len(video_hashes) > MAX_VIDEO_HASHES:
+            # Evicting only forgets the hash; the file itself is untouched.
+            _, evicted_video_id = video_hashes.popitem(last=False)
+            id_to_hash.pop(evicted_video_id, None)
+        return None
+
+def forget_video_hash(video_id):
+    """Remove the hash recorded for video_id so the video can be re-uploaded."""
+    with hashes_lock:
+        file_hash = id_to_hash.pop(video_id, None)
+        if file_hash:
+            video_hashes.pop(file_hash, None)
+
+def load_video_paths():
+    """Rebuild video_paths from the uploads already on disk ({email}_{video_id}.{ext})."""
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.endswith('.part'):
+                continue
+            stem = entry.name.rsplit('.', 1)[0]
+            if '_' in stem:
+                video_paths[stem.rsplit('_', 1)[1]] = entry.path
+
+load_video_paths()
+
+# Single background thread that runs all delayed cleanups from a heap.
+scheduler_wakeup = threading.Event()
+
+def wait_for_scheduler(timeout):
+    """Sleep until the next deadline, or until a new event is scheduled."""
+    scheduler_wakeup.wait(timeout)
+    scheduler_wakeup.clear()
+
+scheduler = sched.scheduler(time.monotonic, wait_for_scheduler)
+
+def run_scheduled(fn, args):
+    """Run a scheduled callback without letting its errors stop the scheduler."""
+    try:
+        fn(*args)
+    except Exception as e:
+        print(f"[{datetime.now()}] Scheduled task error: {e}")
+
+def run_scheduler():
+    while True:
+        scheduler.run()
+        wait_for_scheduler(None)
+
+def schedule(delay, fn, *args):
+    """Run fn(*args) on the scheduler thread after delay seconds and return the event."""
+    event = scheduler.enter(delay, 0, run_scheduled, (fn, args))
+    scheduler_wakeup.set()
+    return event
+
+def cancel_pending_deletion(video_id):
+    """Cancel the inactivity deletion scheduled for video_id, if any."""
+    event = pending_deletions.pop(video_id, None)
+    if event:
+        try:
+            scheduler.cancel(event)
+        except ValueError:
+            pass  # Already ran.
+
+threading.Thread(target=run_scheduler, name='scheduler', daemon=True).start()
 
 def delete_if_not_streamed(video_id, file_path):
     """
     After a delay, if the video hasn't been started for streaming,
     delete the file and remove its hash from video_hashes.
     """
-    if video_id not in active_streams:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"[{datetime.now()}] File '{file_path}' deleted due to inactivity.")
-                # Remove the hash corresponding to video_id.
-                for file_hash, vid in list(video_hashes.items()):
-                    if vid == video_id:
-                        del video_hashes[file_hash]
-        except Exception as e:
-            print(f"Error deleting file: {e}")
+    pending_deletions.pop(video_id, None)
+    with streams_lock:
+        stream = active_streams.get(video_id)
+        if stream and stream['status'] in ('starting', 'live'):
+            return
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            print(f"[{datetime.now()}] File '{file_path}' deleted due to inactivity.")
+            # Remove the hash corresponding to video_id.
+            forget_video_hash(video_id)
+            video_paths.pop(video_id, None)
+    except Exception as e:
+        print(f"Error deleting file: {e}")
 
 @app.route('/upload/<email>', methods=['POST'])
 def upload_video(email):
@@ -57,7 +205,7 @@ def upload_video(email):
     Upload endpoint:
       - Checks for a file.
       - Saves the file.
-      - Computes its hash to check for duplicates.
+      - Hashes it while saving and returns the existing id for duplicates.
       - Schedules a deletion if no stream starts within 15 minutes.
     """
     if 'video' not in request.files:
@@ -75,23 +223,21 @@ def upload_video(email):
         save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
         try:
-            file.save(save_path)
-
-            # Compute file hash for duplicate checking.
-            file_hash = compute_file_hash(save_path)
-            if file_hash in video_hashes:
+            file_hash = save_upload(file.stream, save_path)
+            existing_video_id = remember_video_hash(file_hash, video_id)
+            if existing_video_id:
                 # Duplicate found: remove new file and return existing video id.
+                print(f"[{datetime.now()}] Duplicate of '{existing_video_id}' detected. Removing file.")
                 os.remove(save_path)
-                existing_video_id = video_hashes[file_hash]
                 return jsonify({
                     'message': 'Duplicate video',
                     'videoId': existing_video_id
                 }), 200
-            else:
-                video_hashes[file_hash] = video_id
 
-            # Schedule deletion in 15 minutes if stream not started.
-            threading.Timer(15 * 60, lambda: delete_if_not_streamed(video_id, save_path)).start()
+            # Register the deletion before the id is handed out, so a /start
+            # that follows immediately can always cancel it.
+            pending_deletions[video_id] = schedule(15 * 60, delete_if_not_streamed, video_id, save_path)
+            video_paths[video_id] = save_path
 
             # For this example, we use a dummy duration.
             duration = 120  # Dummy duration in seconds
@@ -118,92 +264,135 @@ def cleanup_process(process):
     except Exception as e:
         print(f"Error cleaning up process: {e}")
 
+def track_stream(video_id, stream):
+    """
+    Store a stream record as the most recently used one. Past
+    MAX_STREAM_RECORDS the least recently used finished records are evicted;
+    starting and live streams are never dropped or stopped to make room.
+    """
+    with streams_lock:
+        active_streams[video_id] = stream
+        active_streams.move_to_end(video_id)
+        excess = len(active_streams) - MAX_STREAM_RECORDS
+        if excess > 0:
+            finished = [vid for vid, record in active_streams.items()
+                        if record['status'] not in ('starting', 'live')]
+            for vid in finished[:excess]:
+                del active_streams[vid]
+    return stream
+
+def get_stream(video_id):
+    """Return the stream record for video_id, marking it as recently used."""
+    with streams_lock:
+        stream = active_streams.get(video_id)
+        if stream:
+            active_streams.move_to_end(video_id)
+        return stream
+
+def watch_ffmpeg_progress(process, stream):
+    """
+    Read FFmpeg's -progress output and keep the stream record current:
+    'live' as soon as frames are being published, 'completed' when FFmpeg
+    reports the end, and the latest progress metrics in between.
+    """
+    progress = {}
+    for line in process.stdout:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        progress[key] = value
+        if key == 'frame' and stream['status'] == 'starting':
+            stream['status'] = 'live'
+        elif key == 'progress':
+            # One progress block is complete; publish a snapshot of it.
+            stream['progress'] = {k: progress.get(k) for k in ('frame', 'fps', 'bitrate', 'out_time', 'speed')}
+            if value == 'end':
+                stream['status'] = 'completed'
+
 def run_ffmpeg_stream(video_path, stream_key, loops, video_id, task_id):
     """
-    Starts an FFmpeg stream in a new terminal window.
-    Once the stream ends, the video file is removed (with a retry mechanism)
+    Runs an FFmpeg stream and logs its output to logs/<video_id>.log.
+    Once the stream ends, the video file is removed
     and its hash is cleared so the same video can be re-uploaded.
     """
+    process = None
+    # Register the record before launching so launch errors are reported too.
+    stream = track_stream(video_id, {
+        'process': None,
+        'status': 'starting',
+        'task_id': task_id,
+        'start_time': datetime.now().isoformat()
+    })
     try:
         print(f"[{datetime.now()}] Starting FFmpeg stream for '{video_path}'")
+        os.makedirs("logs", exist_ok=True)
+        log_file = f"logs/{video_id}.log"
         # Determine output URL: if stream_key starts with 'rtmp://', use it as is.
         if stream_key.startswith("rtmp://"):
             output_url = stream_key
         else:
             output_url = f"rtmp://a.rtmp.youtube.com/live2/{stream_key}"
 
-        # Construct the base FFmpeg command.
-        base_cmd = (
-            f'ffmpeg -re -stream_loop {loops} -i "{video_path}" '
-            f'-c:v libx264 -preset veryfast -b:v 2500k -maxrate 2500k -bufsize 512k '
-            f'-f flv {output_url}'
-        )
-        
-        # Determine OS and build the terminal command.
-        system_platform = platform.system()
-        if system_platform == "Windows":
-            # 'start cmd /k' opens a new command prompt and keeps it open.
-            terminal_cmd = f'start cmd /c "{base_cmd}"'
-        elif system_platform == "Linux":
-            # Using gnome-terminal; adjust if you use a different terminal emulator.
-            terminal_cmd = f'gnome-terminal -- bash -c \'{base_cmd}\''
-        else:
-            # For unsupported systems, run the command directly.
-            terminal_cmd = base_cmd
-
-        # Launch the command in a new terminal.
-        process = subprocess.Popen(terminal_cmd, shell=True)
-        
-        # Save process info in active_streams.
-        active_streams[video_id] = {
-            'process': process,
-            'status': 'starting',
-            'task_id': task_id,
-            'start_time': datetime.now().isoformat()
-        }
-        
-        # Optionally, wait a few seconds to let the process initialize.
-        time.sleep(5)
-        active_streams[video_id]['status'] = 'live'
-
-        # Here, since FFmpeg is running in a separate terminal, monitoring its output is limited.
-        # We'll simply wait for the process to complete.
+        # Build the FFmpeg argv; no shell is involved, so the stream key and
+        # path are passed through verbatim.
+        argv = [
+            'ffmpeg', '-progress', 'pipe:1', '-nostats',
+            '-re', '-stream_loop', str(loops), '-i', video_path,
+            *'-c:v libx264 -preset veryfast -b:v 2500k -maxrate 2500k -bufsize 512k'.split(),
+            '-f', 'flv', output_url
+        ]
+
+        with open(log_file, 'w') as log:
+            # Machine-readable progress arrives on stdout; diagnostics go to the log.
+            process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=log, text=True)
+
+        stream['process'] = process
+
+        # The progress watcher flips the status to 'live' on the first frame.
+        watcher = threading.Thread(target=watch_ffmpeg_progress, args=(process, stream), daemon=True)
+        watcher.start()
         process.wait()
-        active_streams[video_id]['status'] = 'completed'
+        watcher.join()
+        if process.returncode == 0:
+            stream['status'] = 'completed'
+        elif stream['status'] != 'stopped':
+            # e.g. the RTMP connection was refused or dropped.
+            stream['status'] = 'error'
+            stream['error'] = f"ffmpeg exited with code {process.returncode}"
     except Exception as e:
-        active_streams[video_id]['status'] = 'error'
-        active_streams[video_id]['error'] = str(e)
+        stream['status'] = 'error'
+        stream['error'] = str(e)
         print(f"Error in run_ffmpeg_stream: {e}")
     finally:
         cleanup_process(process)
-        # Wait a bit to give the OS time to release the file.
-        time.sleep(2)
-        # Remove the video file after the stream has ended using a retry loop.
-        attempts = 0
-        max_attempts = 5
-        while attempts < max_attempts:
-            try:
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                    print(f"[{datetime.now()}] File '{video_path}' removed after livestream ended.")
-                    # Remove the hash corresponding to video_id.
-                    for file_hash, vid in list(video_hashes.items()):
-                        if vid == video_id:
-                            del video_hashes[file_hash]
-                break  # Exit loop if deletion is successful.
-            except Exception as e:
-                print(f"Error during post-stream cleanup (attempt {attempts+1}): {e}")
-                attempts += 1
-                time.sleep(2)
-        # Optionally, remove the stream record after a delay.
-        threading.Timer(300, lambda: active_streams.pop(video_id, None)).start()
+        if process is None:
+            # FFmpeg never started: keep the upload for another /start and
+            # let it expire as if it had never been streamed.
+            pending_deletions[video_id] = schedule(15 * 60, delete_if_not_streamed, video_id, video_path)
+        else:
+            # FFmpeg has exited, so the file can be unlinked straight away. Windows
+            # may hold the handle for a moment longer and gets a single retry.
+            attempts = 2 if os.name == 'nt' else 1
+            for attempt in range(attempts):
+                try:
+                    if os.path.exists(video_path):
+                        os.remove(video_path)
+                        print(f"[{datetime.now()}] File '{video_path}' removed after livestream ended.")
+                        # Remove the hash corresponding to video_id.
+                        forget_video_hash(video_id)
+                        video_paths.pop(video_id, None)
+                    break
+                except OSError as e:
+                    print(f"Error during post-stream cleanup (attempt {attempt+1}): {e}")
+                    if attempt + 1 < attempts:
+                        time.sleep(0.5)
 
 @app.route('/start/<video_id>', methods=['POST'])
 def start_stream(video_id):
     """
     Start streaming endpoint:
       - Expects JSON with keys: streamKey, loops, taskId.
-      - Finds the video file containing the video_id.
+      - Looks up the uploaded file for the video_id.
       - Starts the streaming (in a background thread) using run_ffmpeg_stream.
     """
     data = request.get_json()
@@ -211,12 +400,14 @@ def start_stream(video_id):
     if not all(field in data for field in required_fields):
         return jsonify({'error': 'Missing required fields'}), 400
 
-    # Find the video file (assumes filename contains the video_id).
-    video_files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if video_id in f]
-    if not video_files:
+    # Look up the file recorded for this video_id at upload time.
+    video_path = video_paths.get(video_id)
+    if not video_path or not os.path.exists(video_path):
         return jsonify({'error': 'Video file not found'}), 404
 
-    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_files[0])
+    # The video is being streamed, so it no longer needs the inactivity deletion.
+    cancel_pending_deletion(video_id)
+
     # Start the FFmpeg streaming in a background thread.
     thread = threading.Thread(
         target=run_ffmpeg_stream,
@@ -233,31 +424,32 @@ def stop_stream(video_id):
     Stop streaming endpoint:
       - Terminates the FFmpeg process for the given video_id and cleans up the stream record.
     """
-    if video_id not in active_streams:
+    with streams_lock:
+        stream_data = active_streams.pop(video_id, None)
+    if not stream_data:
         return jsonify({'error': 'Stream not found'}), 404
 
-    stream_data = active_streams[video_id]
     if stream_data.get('process'):
         cleanup_process(stream_data['process'])
     stream_data['status'] = 'stopped'
     stream_data['process'] = None
-    active_streams.pop(video_id, None)
     return jsonify({'message': 'Stream stopped successfully'}), 200
 
 @app.route('/streams/<video_id>', methods=['GET'])
 def get_stream_status(video_id):
     """
     Get stream status endpoint:
-      - Returns the current state of the stream (e.g. starting, live, completed, error).
+      - Returns the current state of the stream (e.g. starting, live, completed, error)
+        and the latest FFmpeg progress metrics.
     """
-    stream = active_streams.get(video_id)
+    stream = get_stream(video_id)
     if not stream:
         return jsonify({'error': 'Stream not found'}), 404
 
-    if stream.get('process') and stream['process'].poll() is not None:
-        stream['status'] = 'completed'
-        stream['process'] = None
-    return jsonify(stream), 200
+    # run_ffmpeg_stream waits on the process and records how it exited, so
+    # the status is reported as-is. The Popen handle is not serializable; everything else is.
+    return jsonify({key: value for key, value in stream.items() if key != 'process'}), 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; run under gunicorn (see gunicorn.conf.py) in production.
+    app.run(host='0.0.0.0', port=5000)
@@ -1,15 +1,32 @@
+import asyncio
 import os
 import uuid
+import functools
 import hashlib
+import json
+import mimetypes
+import mmap
 import threading
 import time
 import subprocess
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request, jsonify
+from urllib.parse import quote
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 import requests
-import asyncio
-from pyppeteer import launch
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 CORS(app)
@@ -19,34 +36,177 @@ app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # 2GB limit
 # Video Upload/Streaming Setup
 # -----------------------------
 UPLOAD_FOLDER = 'uploads'
+FFMPEG_PATH = "/usr/local/bin/ffmpeg"
+FFPROBE_PATH = "/usr/local/bin/ffprobe"
 ALLOWED_EXTENSIONS = {'mp4', 'mov', 'avi', 'mkv', 'webm'}
+SUPPORTED_PLATFORMS = {'youtube', 'facebook', 'instagram', 'twitter'}
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB fallback reads
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB writes, hashed in the same pass
+LOG_CHUNK_SIZE = 64 * 1024  # ffmpeg log write batch
+MMAP_HASH_THRESHOLD = 100 * 1024 * 1024  # hash larger files via mmap
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['USE_X_ACCEL_REDIRECT'] = os.environ.get('USE_X_ACCEL_REDIRECT') == '1'  # nginx serves /protected/
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 active_streams = {}
+streams_lock = threading.Lock()
 video_hashes = {}
+video_paths = {}  # video_id -> saved upload path
+video_meta = {}  # video_id -> ffprobe codecs/bitrate/container
+video_sha256 = {}  # video_id -> sha256, filled on the first fast-hash hit
+hashes_lock = threading.Lock()  # video_hashes, video_paths, video_meta, video_sha256
+
+timer_loop = asyncio.new_event_loop()  # single thread for all delayed cleanup
+threading.Thread(target=timer_loop.run_forever, name='timers', daemon=True).start()
+timer_handles = {}
+
+def schedule(delay, callback, *args, key=None):
+    def fire():
+        if key is not None:
+            timer_handles.pop(key, None)
+        callback(*args)
+
+    def arm():
+        handle = timer_loop.call_later(delay, fire)
+        if key is not None:
+            timer_handles[key] = handle
+
+    timer_loop.call_soon_threadsafe(arm)
+
+def cancel_scheduled(key):
+    def cancel():
+        handle = timer_handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+    timer_loop.call_soon_threadsafe(cancel)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def compute_file_hash(file_path):
-    sha256 = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with open(file_path, 'rb', buffering=0) as f:
+        if os.fstat(f.fileno()).st_size > MMAP_HASH_THRESHOLD:  # single C call over the page cache
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return hashlib.sha256(mm).hexdigest()
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+: hashing loop runs in C
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
             sha256.update(chunk)
-    return sha256.hexdigest()
+        return sha256.hexdigest()
+
+def new_upload_hasher():  # fast dedup key; sha256 only confirms hits
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def forget_video(video_id):
+    with hashes_lock:
+        video_paths.pop(video_id, None)
+        video_meta.pop(video_id, None)
+        video_sha256.pop(video_id, None)
+        for file_hash, vid in list(video_hashes.items()):
+            if vid == video_id:
+                del video_hashes[file_hash]
+
+def claim_video_hash(file_hash, video_id):  # owner of file_hash; entries whose upload is gone are taken over
+    with hashes_lock:
+        owner = video_hashes.get(file_hash)
+        owner_path = video_paths.get(owner)
+        if owner_path is None or not os.path.exists(owner_path):
+            video_hashes[file_hash] = owner = video_id
+        return owner
+
+def confirm_duplicate(existing_video_id, file_path):  # size, then sha256; new file is still in page cache
+    existing_path = video_paths.get(existing_video_id)
+    try:
+        if not existing_path or os.path.getsize(existing_path) != os.path.getsize(file_path):
+            return False
+        existing_sha256 = video_sha256.get(existing_video_id)
+        if existing_sha256 is None:  # hashed once, then kept
+            existing_sha256 = compute_file_hash(existing_path)
+            with hashes_lock:
+                if existing_video_id in video_paths:
+                    video_sha256[existing_video_id] = existing_sha256
+    except OSError:
+        return False
+    return compute_file_hash(file_path) == existing_sha256
+
+def probe_video(video_id, file_path):
+    try:
+        result = subprocess.run(
+            [FFPROBE_PATH, '-v', 'error', '-of', 'json',
+             '-show_entries', 'stream=codec_type,codec_name,bit_rate,sample_rate,channels:format=bit_rate', file_path],
+            capture_output=True, text=True, timeout=30, check=True)
+        info = json.loads(result.stdout)
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        print(f"[{datetime.now()}] ffprobe failed for '{file_path}': {e}")
+        return
+    meta = {'container': file_path.rsplit('.', 1)[1].lower(), 'video_codec': None, 'audio_codec': None,
+            'audio_sample_rate': None, 'audio_channels': None, 'audio_bitrate': None, 'bitrate': None}
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == 'video' and meta['video_codec'] is None:
+            meta['video_codec'] = stream.get('codec_name')
+            if stream.get('bit_rate'):
+                meta['bitrate'] = int(stream['bit_rate'])
+        elif stream.get('codec_type') == 'audio' and meta['audio_codec'] is None:
+            meta['audio_codec'] = stream.get('codec_name')
+            meta['audio_sample_rate'] = int(stream['sample_rate']) if stream.get('sample_rate') else None
+            meta['audio_channels'] = stream.get('channels')
+            meta['audio_bitrate'] = int(stream['bit_rate']) if stream.get('bit_rate') else None
+    if meta['bitrate'] is None and info.get('format', {}).get('bit_rate'):  # overall rate, an upper bound
+        meta['bitrate'] = int(info['format']['bit_rate'])
+    with hashes_lock:
+        if video_id in video_paths:
+            video_meta[video_id] = meta
 
 def delete_if_not_streamed(video_id, file_path):
-    if video_id not in active_streams:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"[{datetime.now()}] File '{file_path}' deleted due to inactivity.")
-                for file_hash, vid in list(video_hashes.items()):
-                    if vid == video_id:
-                        del video_hashes[file_hash]
-        except Exception as e:
-            print(f"Error deleting file: {e}")
+    with streams_lock:
+        if video_id in active_streams:
+            return
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            print(f"[{datetime.now()}] File '{file_path}' deleted due to inactivity.")
+            forget_video(video_id)
+    except Exception as e:
+        print(f"Error deleting file: {e}")
+
+def video_id_from_filename(name):  # {email}_{video_id}.{ext}
+    if not allowed_file(name):
+        return None
+    stem = name.rsplit('.', 1)[0]
+    return stem.rsplit('_', 1)[1] if '_' in stem else None
+
+def load_video_paths():
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            video_id = video_id_from_filename(entry.name)
+            if video_id and entry.is_file():
+                video_paths[video_id] = entry.path
+
+def watch_upload_folder():  # track files added/removed by other processes
+    inotify = INotify()
+    added = inotify_flags.MOVED_TO  # uploads are renamed into place from .part when complete
+    inotify.add_watch(UPLOAD_FOLDER, added | inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+    while True:
+        for event in inotify.read():
+            video_id = video_id_from_filename(event.name)
+            if video_id is None:
+                continue
+            path = os.path.join(UPLOAD_FOLDER, event.name)
+            if event.mask & added:
+                with hashes_lock:
+                    video_paths[video_id] = path
+            elif video_paths.get(video_id) == path:
+                forget_video(video_id)  # its hashes too, or they'd shadow a re-upload
+
+load_video_paths()
+if INotify is not None:
+    threading.Thread(target=watch_upload_folder, name='uploads-watch', daemon=True).start()
 
 @app.route('/upload/<email>', methods=['POST'])
 def upload_video(email):
@@ -60,42 +220,76 @@ def upload_video(email):
         ext = file.filename.rsplit('.', 1)[1].lower()
         filename = f"{email}_{video_id}.{ext}"
         save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        part_path = save_path + '.part'  # renamed into place once accepted, so the watcher never sees partial files
         try:
-            with open(save_path, 'wb') as f:
+            hasher = new_upload_hasher()
+            with open(part_path, 'wb') as f:
+                if request.content_length and hasattr(os, 'posix_fallocate'):  # body size is an upper bound
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, request.content_length)
+                    except OSError:
+                        pass
                 while True:
-                    chunk = file.stream.read(4096)
+                    chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
                     if not chunk:
                         break
+                    hasher.update(chunk)
                     f.write(chunk)
-            response = jsonify({
+                f.truncate()  # drop the unused preallocation
+            file_hash = hasher.hexdigest()
+            existing_video_id = claim_video_hash(file_hash, video_id)
+            if existing_video_id != video_id:
+                if confirm_duplicate(existing_video_id, part_path):
+                    os.remove(part_path)
+                    print(f"[{datetime.now()}] Duplicate detected. File removed.")
+                    return jsonify({'message': 'Duplicate video', 'videoId': existing_video_id}), 200
+            os.replace(part_path, save_path)
+            with hashes_lock:
+                video_paths[video_id] = save_path
+            schedule(15 * 60, delete_if_not_streamed, video_id, save_path, key=video_id)
+            threading.Thread(target=probe_video, args=(video_id, save_path), daemon=True).start()
+            return jsonify({
                 'message': 'File uploaded successfully',
                 'videoId': video_id,
                 'filename': filename,
                 'duration': 120
-            })
-            response.status_code = 200
-
-            def post_process():
-                try:
-                    file_hash = compute_file_hash(save_path)
-                    if file_hash in video_hashes:
-                        os.remove(save_path)
-                        print(f"[{datetime.now()}] Duplicate detected. File removed.")
-                    else:
-                        video_hashes[file_hash] = video_id
-                        threading.Timer(15 * 60, lambda: delete_if_not_streamed(video_id, save_path)).start()
-                except Exception as e:
-                    print(f"[{datetime.now()}] Post-process error: {e}")
-
-            threading.Thread(target=post_process).start()
-            return response
+            }), 200
         except Exception as e:
+            for path in (part_path, save_path):  # no half-written or preallocated file left behind
+                if os.path.exists(path):
+                    os.remove(path)
+            forget_video(video_id)  # nor the hash it claimed
             return jsonify({'error': str(e)}), 500
     return jsonify({'error': 'Invalid file type'}), 400
 
+# nginx: location /protected/ { internal; alias /path/to/uploads/; sendfile on; tcp_nopush on; aio threads; }
+@app.route('/video/<video_id>', methods=['GET'])
+def serve_video(video_id):
+    video_path = video_paths.get(video_id)
+    if not video_path or not os.path.exists(video_path):
+        return jsonify({'error': 'Video file not found'}), 404
+    mimetype = mimetypes.guess_type(video_path)[0] or 'application/octet-stream'
+    if not app.config['USE_X_ACCEL_REDIRECT']:
+        return send_file(video_path, mimetype=mimetype, conditional=True)
+    response = app.response_class(mimetype=mimetype)
+    response.headers['X-Accel-Redirect'] = f"/protected/{quote(os.path.basename(video_path))}"
+    return response
+
 # -----------------------------
 # FFmpeg Streaming Functions
 # -----------------------------
+def update_stream(video_id, **fields):
+    with streams_lock:
+        record = active_streams.get(video_id)
+        if record is not None:
+            record.update(fields)
+
+def forget_stream(video_id):  # a relaunch after a failed start keeps its record
+    with streams_lock:
+        record = active_streams.get(video_id)
+        if record is not None and record['status'] not in ('starting', 'live'):
+            del active_streams[video_id]
+
 def cleanup_process(process):
     try:
         if process and process.poll() is None:
@@ -106,12 +300,99 @@ def cleanup_process(process):
     except Exception as e:
         print(f"Error cleaning up process: {e}")
 
+HW_ENCODERS = {  # preference order: name -> (pre-input flags, encoder flags)
+    'h264_nvenc': ([], ['-preset', 'p4', '-rc', 'cbr']),
+    'h264_qsv': ([], ['-preset', 'veryfast']),
+    'h264_vaapi': (['-vaapi_device', '/dev/dri/renderD128'], ['-vf', 'format=nv12,hwupload', '-rc_mode', 'CBR']),
+}
+
+@functools.lru_cache(maxsize=None)
+def detect_hw_encoder():  # test-encode one frame per candidate, cached
+    for encoder, (input_flags, encoder_opts) in HW_ENCODERS.items():
+        try:
+            result = subprocess.run(
+                [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', *input_flags,
+                 '-f', 'lavfi', '-i', 'nullsrc=s=256x256:d=1', '-frames:v', '1',
+                 '-c:v', encoder, *encoder_opts, '-f', 'null', '-'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=15
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        if result.returncode == 0:
+            print(f"[{datetime.now()}] Using hardware encoder {encoder}")
+            return encoder
+    return None
+
+def encoder_flags(common_flags):  # swap libx264 + x264-only options for the hw encoder
+    tokens = common_flags.split()
+    encoder = detect_hw_encoder()
+    if encoder is None:
+        return [], tokens
+    input_flags, encoder_opts = HW_ENCODERS[encoder]
+    codec_flags = []
+    it = iter(tokens)
+    for token in it:
+        if token in ('-preset', '-x264-params'):
+            next(it, None)
+            continue
+        codec_flags.append(encoder if token == 'libx264' else token)
+    return input_flags, codec_flags + encoder_opts
+
+def can_stream_copy(meta, common_flags):  # h264 (+aac matching -ar/-ac/-b:a) in mp4/mov/flv within the platform bitrate, no strict CBR
+    if not meta or meta['video_codec'] != 'h264' or meta['audio_codec'] not in (None, 'aac'):
+        return False
+    if meta['container'] not in ('mp4', 'mov', 'flv') or meta['bitrate'] is None:
+        return False
+    tokens = common_flags.split()
+    if 'nal-hrd=cbr:force-cfr=1' in tokens or '-b:v' not in tokens:
+        return False
+    if meta['audio_codec'] is not None:
+        if '-ar' in tokens and meta['audio_sample_rate'] != int(tokens[tokens.index('-ar') + 1]):
+            return False
+        if '-ac' in tokens and meta['audio_channels'] != int(tokens[tokens.index('-ac') + 1]):
+            return False
+        if '-b:a' in tokens:
+            audio_target = int(tokens[tokens.index('-b:a') + 1].rstrip('k')) * 1000
+            if meta['audio_bitrate'] is None or meta['audio_bitrate'] > audio_target:
+                return False
+    target = tokens[tokens.index('-b:v') + 1]
+    return meta['bitrate'] <= int(target.rstrip('k')) * 1000
+
+threading.Thread(target=detect_hw_encoder, daemon=True).start()
+
+def pump_log(pipe, log_file):  # batch ffmpeg diagnostics into few large log writes
+    with pipe, open(log_file, 'wb', buffering=LOG_CHUNK_SIZE) as log:
+        while True:
+            chunk = pipe.read1(LOG_CHUNK_SIZE)
+            if not chunk:
+                break
+            log.write(chunk)
+
+def watch_ffmpeg_progress(pipe, video_id):  # -progress output -> 'live' on first frame + latest metrics
+    progress = {}
+    with pipe:
+        for line in pipe:
+            key, sep, value = line.decode(errors='replace').strip().partition('=')
+            if not sep:
+                continue
+            progress[key] = value
+            if key == 'frame':  # only reported once the output is open and accepting data
+                with streams_lock:
+                    record = active_streams.get(video_id)
+                    if record is not None and record['status'] == 'starting':
+                        record['status'] = 'live'
+            elif key == 'progress':
+                update_stream(video_id, progress={k: progress.get(k) for k in ('frame', 'fps', 'bitrate', 'out_time', 'speed')})
+
 def run_ffmpeg_stream(video_path, stream_key, loops, video_id, task_id, platform):
+    process = None
     try:
+        cancel_scheduled(video_id)  # streaming now, don't expire the upload
         os.makedirs("logs", exist_ok=True)
         log_file = f"logs/{video_id}.log"
-        ffmpeg_path = "/usr/local/bin/ffmpeg"
-        ffmpeg_input = f'-re -stream_loop {loops} -i "{video_path}"'
+        ffmpeg_input = ['-re', '-stream_loop', str(loops), '-i', video_path]
 
         if platform == 'youtube':
             output_url = f'rtmp://a.rtmp.youtube.com/live2/{stream_key}'
@@ -136,52 +417,63 @@ def run_ffmpeg_stream(video_path, stream_key, loops, video_id, task_id, platform
         else:
             return f"Unsupported platform: {platform}"
 
-        base_cmd = f'{ffmpeg_path} {ffmpeg_input} {common_flags} {format_flags} "{output_url}"'
-
-        with open(log_file, 'w') as log:
-            process = subprocess.Popen(
-                base_cmd,
-                shell=True,
-                stdout=log,
-                stderr=subprocess.STDOUT,
-                executable='/bin/bash'
-            )
-
-        active_streams[video_id] = {
-            'process': process,
-            'status': 'starting',
-            'task_id': task_id,
-            'start_time': datetime.now().isoformat()
-        }
+        if can_stream_copy(video_meta.get(video_id), common_flags):
+            hw_flags, codec_flags = [], ['-c', 'copy']  # source already fits, skip the encoder
+        else:
+            hw_flags, codec_flags = encoder_flags(common_flags)
+        argv = [FFMPEG_PATH, '-progress', 'pipe:1', '-nostats', *hw_flags, *ffmpeg_input,
+                *codec_flags, *format_flags.split(), output_url]  # progress on stdout, diagnostics on stderr
 
-        time.sleep(5)
-        active_streams[video_id]['status'] = 'live'
+        with streams_lock:  # registered before launch so launch errors are reported too
+            active_streams[video_id] = {
+                'process': None,
+                'status': 'starting',
+                'task_id': task_id,
+                'start_time': datetime.now().isoformat()
+            }
+        process = subprocess.Popen(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=1024 * 1024,
+            close_fds=True
+        )
+        log_writer = threading.Thread(target=pump_log, args=(process.stderr, log_file), daemon=True)
+        log_writer.start()
+        update_stream(video_id, process=process)
+        watcher = threading.Thread(target=watch_ffmpeg_progress, args=(process.stdout, video_id), daemon=True)
+        watcher.start()  # 'live' on the first frame, not after a fixed wait
         process.wait()
-        active_streams[video_id]['status'] = 'completed'
+        log_writer.join()
+        watcher.join()
+        if process.returncode == 0:
+            update_stream(video_id, status='completed')
+        else:
+            update_stream(video_id, status='error', error=f"ffmpeg exited with code {process.returncode}")
 
     except Exception as e:
-        active_streams[video_id]['status'] = 'error'
-        active_streams[video_id]['error'] = str(e)
+        update_stream(video_id, status='error', error=str(e))
         print(f"Error in run_ffmpeg_stream: {e}")
     finally:
         cleanup_process(process)
-        time.sleep(2)
-        attempts = 0
-        max_attempts = 5
-        while attempts < max_attempts:
-            try:
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                    print(f"[{datetime.now()}] File '{video_path}' removed after livestream ended.")
-                    for file_hash, vid in list(video_hashes.items()):
-                        if vid == video_id:
-                            del video_hashes[file_hash]
-                break
-            except Exception as e:
-                print(f"Error during post-stream cleanup (attempt {attempts+1}): {e}")
-                attempts += 1
-                time.sleep(2)
-        threading.Timer(300, lambda: active_streams.pop(video_id, None)).start()
+        if process is None:  # never launched: keep the upload and let it expire as usual
+            schedule(15 * 60, delete_if_not_streamed, video_id, video_path, key=video_id)
+        else:
+            time.sleep(2)
+            attempts = 0
+            max_attempts = 5
+            while attempts < max_attempts:
+                try:
+                    if os.path.exists(video_path):
+                        os.remove(video_path)
+                        print(f"[{datetime.now()}] File '{video_path}' removed after livestream ended.")
+                        forget_video(video_id)
+                    break
+                except Exception as e:
+                    print(f"Error during post-stream cleanup (attempt {attempts+1}): {e}")
+                    attempts += 1
+                    time.sleep(2)
+        schedule(300, forget_stream, video_id)
 
 @app.route('/start/<video_id>', methods=['POST'])
 def start_stream(video_id):
@@ -189,10 +481,11 @@ def start_stream(video_id):
     required_fields = ['streamKey', 'loops', 'taskId', 'platform']
     if not all(field in data for field in required_fields):
         return jsonify({'error': 'Missing required fields'}), 400
-    video_files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if video_id in f]
-    if not video_files:
+    if data['platform'] not in SUPPORTED_PLATFORMS:
+        return jsonify({'error': f"Unsupported platform: {data['platform']}"}), 400
+    video_path = video_paths.get(video_id)
+    if not video_path or not os.path.exists(video_path):
         return jsonify({'error': 'Video file not found'}), 404
-    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_files[0])
     thread = threading.Thread(
         target=run_ffmpeg_stream,
         args=(video_path, data['streamKey'], data['loops'], video_id, data['taskId'], data['platform'])
@@ -204,69 +497,145 @@ def start_stream(video_id):
 # -----------------------------
 # NSE Index/Equity API Integration
 # -----------------------------
-index_cache = {}  # 30s cache
-equity_cookie_cache = {'cookie': None, 'timestamp': 0}  # 5 min cache
+class TTLCache:  # bounded, insertion-ordered dict of key -> (value, stored_at) behind a lock; safe to share across threads
+    def __init__(self, ttl, max_stale=None, maxsize=1024):
+        self.ttl = ttl
+        self.max_stale = ttl if max_stale is None else max_stale  # entries older than this are purged
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # oldest write first
+        self.lock = threading.Lock()
+
+    def get(self, key, max_age=None):  # value if younger than max_age (default: ttl), else None
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry[1] >= (self.ttl if max_age is None else max_age):
+            return None
+        return entry[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, now)
+            while self.entries:  # drop expired entries from the old end
+                oldest = next(iter(self.entries.values()))
+                if now - oldest[1] < self.max_stale:
+                    break
+                self.entries.popitem(last=False)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+index_cache = TTLCache(30)
+equity_cookie_cache = TTLCache(300)
+equity_data_cache = TTLCache(30, max_stale=60)  # served stale up to 60s while refreshing
+
+MAX_FETCH_LOCKS = 1024
+fetch_locks = {}  # ('index'|'equity', symbol) or 'cookie' -> one upstream fetch at a time
+fetch_locks_lock = threading.Lock()
+
+def fetch_lock(key):
+    with fetch_locks_lock:
+        lock = fetch_locks.get(key)
+        if lock is None:
+            if len(fetch_locks) >= MAX_FETCH_LOCKS:  # forget idle locks so arbitrary symbols can't grow this forever
+                for idle in [k for k, l in fetch_locks.items() if not l.locked()]:
+                    del fetch_locks[idle]
+            lock = fetch_locks[key] = threading.Lock()
+        return lock
+
+# NSE hands out its cookies to plain HTTP clients, no browser needed.
+nse_session = requests.Session()
+nse_session.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'en-US,en;q=0.9',
+})
+# Reuse TCP/TLS connections to nseindia.com across requests.
+nse_session.mount('https://', HTTPAdapter(
+    pool_connections=32, pool_maxsize=64, max_retries=Retry(total=2, backoff_factor=0.2)))
+
+def json_response(body):  # cached bytes go out as-is, no json.dumps per hit
+    return app.response_class(body, mimetype='application/json')
 
 # Index Option-Chain
 @app.route('/nse-index', methods=['GET'])
 def nse_index():
     symbol = request.args.get('symbol', 'NIFTY').upper()
-    now = time.time()
-    if symbol in index_cache and now - index_cache[symbol]['timestamp'] < 30:
-        return jsonify(index_cache[symbol]['data'])
+    body = index_cache.get(symbol)
+    if body is not None:
+        return json_response(body)
     url = f'https://www.nseindia.com/api/option-chain-indices?symbol={symbol}'
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-        'Accept': 'application/json, text/plain, */*',
-        'Referer': 'https://www.nseindia.com/option-chain'
-    }
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        index_cache[symbol] = {'data': data, 'timestamp': now}
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    headers = {'Referer': 'https://www.nseindia.com/option-chain'}
+    with fetch_lock(('index', symbol)):
+        body = index_cache.get(symbol)
+        if body is not None:
+            return json_response(body)  # filled while we waited
+        try:
+            resp = nse_session.get(url, headers=headers, timeout=10)
+            resp.raise_for_status()
+            resp.json()  # validate once; keep NSE's own bytes
+            index_cache.set(symbol, resp.content)
+            return json_response(resp.content)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
 
 # Equity Option-Chain
-async def get_nse_cookies():
-    now = time.time()
-    if equity_cookie_cache['cookie'] and now - equity_cookie_cache['timestamp'] < 300:
-        return equity_cookie_cache['cookie']
-    browser = await launch(headless=True, args=['--no-sandbox'])
-    page = await browser.newPage()
-    await page.goto('https://www.nseindia.com', {'waitUntil': 'networkidle2'})
-    cookies = await page.cookies()
-    await browser.close()
-    cookie_header = '; '.join([f"{c['name']}={c['value']}" for c in cookies])
-    equity_cookie_cache['cookie'] = cookie_header
-    equity_cookie_cache['timestamp'] = now
-    return cookie_header
-
-def fetch_equity_option_chain(symbol, cookie_header):
+def get_nse_cookies_sync():
+    cookies = equity_cookie_cache.get('cookie')
+    if cookies is not None:
+        return cookies
+    with fetch_lock('cookie'):  # one warmup at a time
+        cookies = equity_cookie_cache.get('cookie')
+        if cookies is not None:
+            return cookies
+        nse_session.get('https://www.nseindia.com', timeout=5)
+        nse_session.get('https://www.nseindia.com/option-chain', timeout=5)
+        equity_cookie_cache.set('cookie', nse_session.cookies)
+        return nse_session.cookies
+
+def fetch_equity_option_chain(symbol):
     url = f'https://www.nseindia.com/api/option-chain-equities?symbol={symbol}'
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-        'Accept': 'application/json, text/plain, */*',
-        'Referer': 'https://www.nseindia.com',
-        'Cookie': cookie_header
-    }
-    response = requests.get(url, headers=headers, timeout=10)
+    response = nse_session.get(url, headers={'Referer': 'https://www.nseindia.com/option-chain'}, timeout=10)
     response.raise_for_status()
-    return response.json()
+    response.json()
+    return response.content
+
+def refresh_equity_data(symbol):
+    get_nse_cookies_sync()
+    body = fetch_equity_option_chain(symbol)
+    equity_data_cache.set(symbol, body)
+    return body
+
+def refresh_equity_in_background(symbol, lock):
+    try:
+        refresh_equity_data(symbol)
+    except Exception as e:
+        print(f"[{datetime.now()}] Equity refresh error for {symbol}: {e}")
+    finally:
+        lock.release()
 
 @app.route('/nse-equity', methods=['GET'])
 def nse_equity():
     symbol = request.args.get('symbol', '').upper()
     if not symbol:
         return jsonify({'error': 'Symbol is required'}), 400
-    try:
-        cookie_header = asyncio.get_event_loop().run_until_complete(get_nse_cookies())
-        data = fetch_equity_option_chain(symbol, cookie_header)
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    body = equity_data_cache.get(symbol)
+    if body is not None:
+        return json_response(body)
+    body = equity_data_cache.get(symbol, max_age=60)
+    if body is not None:  # stale: answer now, refresh behind the response
+        lock = fetch_lock(('equity', symbol))
+        if lock.acquire(blocking=False):  # skip if a refresh is already running
+            threading.Thread(target=refresh_equity_in_background, args=(symbol, lock), daemon=True).start()
+        return json_response(body)
+    with fetch_lock(('equity', symbol)):
+        body = equity_data_cache.get(symbol)
+        if body is not None:
+            return json_response(body)  # filled while we waited
+        try:
+            return json_response(refresh_equity_data(symbol))
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
 
 # -----------------------------
 if __name__ == '__main__':
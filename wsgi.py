@@ -0,0 +1,3 @@
+# WSGI entry point for the combined video + NSE app:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+from new import app